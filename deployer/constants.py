@@ -24,6 +24,12 @@ MAX_WORKERS_PARALLEL_UPLOADS = config(
     "DEPLOYER_MAX_WORKERS_PARALLEL_UPLOADS", default=50, cast=int
 )
 
+# Listing what's already in the bucket is done with one thread per top-level
+# "folder" under the prefix.
+MAX_WORKERS_PARALLEL_LISTINGS = config(
+    "DEPLOYER_MAX_WORKERS_PARALLEL_LISTINGS", default=16, cast=int
+)
+
 # E.g. /en-US/docs/Foo/Bar/index.html
 DEFAULT_CACHE_CONTROL = config(
     "DEPLOYER_DEFAULT_CACHE_CONTROL", default=60 * 60, cast=int
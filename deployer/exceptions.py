@@ -4,3 +4,7 @@ class CoreException(Exception):
 
 class NoGitDirectory(CoreException):
     """When trying to find a/the git directory and failing."""
+
+
+class CantDryRunError(CoreException):
+    """When something that needs to be done can't be done in dry-run mode."""
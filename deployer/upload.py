@@ -1,5 +1,6 @@
 import concurrent.futures
 import datetime
+import functools
 import getpass
 import hashlib
 import mimetypes
@@ -13,6 +14,7 @@ from pathlib import Path
 import boto3
 import git
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from git.exc import InvalidGitRepositoryError
 
@@ -21,43 +23,107 @@ from .constants import (
     DEFAULT_CACHE_CONTROL,
     DEFAULT_NAME_PATTERN,
     HASHED_CACHE_CONTROL,
+    MAX_WORKERS_PARALLEL_LISTINGS,
     MAX_WORKERS_PARALLEL_UPLOADS,
 )
 from .exceptions import NoGitDirectory, CantDryRunError
 from .utils import fmt_seconds, fmt_size, info, is_junk_file, ppath, success, warning
 
 hashed_filename_regex = re.compile(r"\.[a-f0-9]{8,32}\.")
+# Stricter, for when the name alone is trusted to say the content hasn't changed.
+# A real hex digest will have at least one letter in it, unlike, for example,
+# a date stamp like 'report.20200101.pdf'.
+digest_filename_regex = re.compile(r"\.(?=[0-9]*[a-f])[a-f0-9]{8,32}\.")
+
+# How much of a file to feed into the hasher at a time. Big enough that
+# hashlib (which releases the GIL while it works) does most of the work
+# without going back to Python, small enough to not hold a whole big file
+# in memory per worker thread.
+MD5_BUFSIZE = 1024 * 1024
 
 
 def _find_git_repo(start):
-    if str(start) == str(start.root):
-        raise NoGitDirectory
     try:
-        return git.Repo(start)
+        return git.Repo(start, search_parent_directories=True)
     except InvalidGitRepositoryError:
-        return _find_git_repo(Path(start).parent)
+        raise NoGitDirectory
+
+
+def _md5_file(file_path):
+    hasher = hashlib.md5()
+    with open(file_path, "rb", buffering=0) as f:
+        while True:
+            chunk = f.read(MD5_BUFSIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _guess_mime_type(extension):
+    return mimetypes.guess_type(f"file{extension}")[0] or "binary/octet-stream"
+
+
+def _get_mime_type(file_name):
+    root, extension = os.path.splitext(file_name)
+    if extension.lower() in mimetypes.encodings_map:
+        # E.g. 'foo.js.gz' is typed by guess_type() from the '.js' before the
+        # encoding suffix, so that needs to be part of the cache key too.
+        extension = os.path.splitext(root)[1] + extension
+    return _guess_mime_type(extension)
 
 
 def _has_hashed_filename(fn):
-    return hashed_filename_regex.findall(os.path.basename(fn))
+    return hashed_filename_regex.search(os.path.basename(fn)) is not None
+
+
+def _has_digest_filename(fn):
+    return digest_filename_regex.search(os.path.basename(fn)) is not None
+
+
+def _get_cache_control(file_name, hashed_filename):
+    if file_name == "service-worker.js":
+        return "no-cache"
+    cache_control_seconds = DEFAULT_CACHE_CONTROL
+    if hashed_filename:
+        cache_control_seconds = HASHED_CACHE_CONTROL
+    return f"max-age={cache_control_seconds}, public"
 
 
 @dataclass()
 class UploadTask:
     """All the relevant information for doing an upload"""
 
+    # There's one of these for every file in the site, so skip the per-instance
+    # __dict__. (Spelled out rather than `dataclass(slots=True)` which needs
+    # Python 3.10.) This means the fields can't have default values.
+    __slots__ = (
+        "key",
+        "file_path",
+        "size",
+        "file_hash",
+        "needs_hash_check",
+        "etag",
+        "mime_type",
+        "cache_control",
+    )
+
     key: str
-    file_path: Path
+    file_path: str
     size: int
     file_hash: str
     needs_hash_check: bool
+    # The ETag of the existing S3 object, when there is one to compare against.
+    etag: str
+    mime_type: str
+    cache_control: str
 
     def __repr__(self):
         return repr(self.key)
 
     def set_file_hash(self):
-        with open(self.file_path, "rb") as f:
-            self.file_hash = hashlib.md5(f.read()).hexdigest()
+        self.file_hash = _md5_file(self.file_path)
 
 
 def upload_site(directory, config):
@@ -90,7 +156,18 @@ def upload_site(directory, config):
     )
 
     session = boto3.Session(profile_name=AWS_PROFILE)
-    s3 = session.client("s3")
+    # The client is shared by every upload worker thread. The default connection
+    # pool (10) is smaller than the thread pool and would make workers queue up
+    # (and log "Connection pool is full") so size it to match, with some room
+    # for the parts of multipart uploads.
+    s3 = session.client(
+        "s3",
+        config=Config(
+            max_pool_connections=MAX_WORKERS_PARALLEL_UPLOADS * 2,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            tcp_keepalive=True,
+        ),
+    )
 
     # First make sure the bucket exists
     try:
@@ -164,51 +241,56 @@ def upload_site(directory, config):
     if config["debug"]:
         info(f"Website bucket: {website_bucket!r}")
 
+    def list_uploaded_already():
+        t0 = time.time()
+        found = _list_uploaded_already(s3, config["bucket"], f"{config['name']}/")
+        return found, time.time() - t0
+
     uploaded_already = {}
 
-    if config["refresh"]:
-        info("Refresh, so ignoring what was previously uploaded.")
-    else:
-        info(
-            f"Gather complete list of existing uploads under prefix "
-            f"{config['name']!r}..."
-        )
+    # Listing what's already in the bucket is nothing but network round-trips,
+    # so do that in the background while the local directory is counted.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        if config["refresh"]:
+            info("Refresh, so ignoring what was previously uploaded.")
+            listing = None
+        else:
+            info(
+                f"Gather complete list of existing uploads under prefix "
+                f"{config['name']!r}..."
+            )
+            listing = executor.submit(list_uploaded_already)
+
+        total_todo = 0
         t0 = time.time()
-        continuation_token = None
-        while True:
-            # Have to do this so that 'ContinuationToken' can be omitted if falsy
-            list_kwargs = dict(Bucket=config["bucket"], Prefix=config["name"])
-            if continuation_token:
-                list_kwargs["ContinuationToken"] = continuation_token
-            response = s3.list_objects_v2(**list_kwargs)
-            for obj in response.get("Contents", []):
-                uploaded_already[obj["Key"]] = obj
-            if response["IsTruncated"]:
-                continuation_token = response["NextContinuationToken"]
-            else:
-                break
+        for entry in pwalk(directory):
+            if is_junk_file(entry):
+                continue
+            if entry.name.startswith("_"):
+                continue
+            total_todo += 1
         t1 = time.time()
-
         warning(
-            f"{len(uploaded_already):,} files already uploaded "
+            f"{total_todo:,} files to be (maybe) uploaded "
             f"(took {fmt_seconds(t1 - t0)})."
         )
 
-    total_todo = 0
-    t0 = time.time()
-    for fp in pwalk(directory):
-        if is_junk_file(fp):
-            continue
-        if fp.name.startswith("_"):
-            continue
-        total_todo += 1
-    t1 = time.time()
-    warning(
-        f"{total_todo:,} files to be (maybe) uploaded "
-        f"(took {fmt_seconds(t1 - t0)})."
-    )
+        if listing:
+            uploaded_already, took = listing.result()
+            warning(
+                f"{len(uploaded_already):,} files already uploaded "
+                f"(took {fmt_seconds(took)})."
+            )
 
-    transfer_config = TransferConfig()
+    # Only files at or above the multipart threshold go through s3transfer (see
+    # _upload_file_maybe), each of them on one of the upload worker threads
+    # already, so keep the number of extra threads per file small.
+    transfer_config = TransferConfig(
+        multipart_threshold=64 * 1024 * 1024,
+        multipart_chunksize=16 * 1024 * 1024,
+        max_concurrency=4,
+        io_chunksize=1024 * 1024,
+    )
 
     # Number of files that don't need to be uploaded because they are already uploaded
     # with a difference.
@@ -217,35 +299,45 @@ def upload_site(directory, config):
     # Number of files we deliberate chose to NOT upload. Or even attempt to.
     ignored = 0
 
-    # Use this pattern in case there's a file without extension.
-    # for fp in directory.glob("**/*"):
-    # if fp.is_dir():
-    #     # E.g. /pl/Web/API/docs/WindowBase64.atob/ which is
-    #     continue
     counts = {"uploaded": 0, "not_uploaded": 0}
 
     total_size = []
     total_time = []
+    progress_bar = {"percentage": None, "line": None}
 
-    def update_uploaded_stats(stats):
-        counts["uploaded"] += stats["counts"].get("uploaded")
-        counts["not_uploaded"] += stats["counts"].get("not_uploaded")
-        total_size.append(stats["total_size_uploaded"])
-        total_time.append(stats["total_time"])
+    def update_uploaded_stats(task, was_uploaded, took):
+        total_time.append(took)
+        if was_uploaded:
+            counts["uploaded"] += 1
+            total_size.append(task.size)
+        else:
+            counts["not_uploaded"] += 1
         if not config["no_progress_bar"]:
-            done = counts["uploaded"] + counts["not_uploaded"]
-            percentage = 100 * done / total_todo
-            max_bar_width = shutil.get_terminal_size((80, 20)).columns
-            bar_width = int(max_bar_width * done / total_todo)
-            print(
-                f"{done:,} of {total_todo:,}".ljust(20)
-                + f"[{'▋' * bar_width:<{max_bar_width}}] "
-                f"{percentage:.1f}%\r",
-                end="",
-            )
-
-    total_count = 0
-    batch = []
+            draw_progress_bar()
+
+    def draw_progress_bar():
+        # Files skipped during the scan count as done too, otherwise the bar
+        # could never reach the end.
+        done = counts["uploaded"] + counts["not_uploaded"] + skipped
+        percentage = 100 * done / total_todo
+        # This is called for every file so only redraw the progress bar when
+        # the percentage, as displayed, has actually changed. Except the very
+        # last one, so that the final count and a full bar always get drawn.
+        if done != total_todo and f"{percentage:.1f}" == progress_bar["percentage"]:
+            return
+        progress_bar["percentage"] = f"{percentage:.1f}"
+        max_bar_width = shutil.get_terminal_size((80, 20)).columns
+        bar_width = int(max_bar_width * done / total_todo)
+        line = (
+            f"{done:,} of {total_todo:,}".ljust(20)
+            + f"[{'▋' * bar_width:<{max_bar_width}}] "
+            f"{percentage:.1f}%"
+        )
+        # E.g. the final draw after all uploads, when the last one drew it already.
+        if line == progress_bar["line"]:
+            return
+        progress_bar["line"] = line
+        print(f"{line}\r", end="")
 
     if config["no_progress_bar"]:
         log = info
@@ -258,73 +350,94 @@ def upload_site(directory, config):
             with open(current_log_file_name, "a") as f:
                 f.write(f"{line}\n")
 
-    T0 = time.time()
-    for fp in pwalk(directory):
-        if is_junk_file(fp):
-            ignored += 1
-            continue
-        if fp.name.startswith("_"):
-            ignored += 1
-            continue
-        # This assumes  that it can saved in S3 as a key that is the filename.
-        key_path = fp.relative_to(directory)
-        # if key_path.name == "index.redirect":
-        #     # Call these index.html when they go into S3
-        #     key_path = key_path.parent / "index.html"
-        key = f"{config['name']}/{key_path}"
-
-        size = fp.stat().st_size
-        # with open(fp, "rb") as f:
-        #     file_hash = hashlib.md5(f.read()).hexdigest()
-        task = UploadTask(key, fp, size, None, False)
-        if key not in uploaded_already or uploaded_already[key]["Size"] != size:
-            # No doubt! We definitely didn't have this before or it's definitely
-            # different.
-            batch.append(task)
+    # Uploads are submitted as the directory is walked, to one thread pool that
+    # lives (and keeps its connections warm) for the whole upload. To not queue
+    # up every task of a big site at once, only so many are allowed in flight.
+    max_in_flight = MAX_WORKERS_PARALLEL_UPLOADS * 2
+    in_flight = {}
 
-        else:
-            # At this point, the key exists and the size hasn't changed.
-            # However, for some files, that's not conclusive.
-            # Image, a 'index.html' file might have this as its diff:
-            #
-            #    - <script src=/foo.a9bef19a0.js></script>
-            #    + <script src=/foo.3e98ca01d.js></script>
-            #
-            # ...which means it definitely has changed but the file size is
-            # exactly the same as before.
-            # If this is the case, we're going to *maybe* upload it.
-            # However, for files that are already digest hashed, we don't need
-            # to bother checking.
-            if _has_hashed_filename(key):
-                # skipped.append(task)
+    def wait_for_uploads(return_when):
+        done, _ = concurrent.futures.wait(in_flight, return_when=return_when)
+        for future in done:
+            task = in_flight.pop(future)
+            was_uploaded, took = future.result()
+            update_uploaded_stats(task, was_uploaded, took)
+
+    T0 = time.time()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_WORKERS_PARALLEL_UPLOADS
+    ) as executor:
+        for entry in pwalk(directory):
+            if is_junk_file(entry):
+                ignored += 1
+                continue
+            if entry.name.startswith("_"):
+                ignored += 1
+                continue
+            # This assumes  that it can saved in S3 as a key that is the filename.
+            key_path = os.path.relpath(entry.path, directory)
+            # if key_path.name == "index.redirect":
+            #     # Call these index.html when they go into S3
+            #     key_path = key_path.parent / "index.html"
+            key = f"{config['name']}/{key_path}"
+
+            hashed_filename = _has_hashed_filename(entry.name)
+            if (
+                hashed_filename
+                and key in uploaded_already
+                and _has_digest_filename(entry.name)
+            ):
+                # Files that are already digest hashed (e.g. 'main.3e98ca01d.js')
+                # have their content in the name. If the key exists, it's the
+                # same content, whatever the size says.
                 skipped += 1
                 continue
-            else:
+            # DirEntry caches its stat() (on Windows it even comes with the scandir()).
+            size = entry.stat().st_size
+            task = UploadTask(
+                key=key,
+                file_path=entry.path,
+                size=size,
+                file_hash=None,
+                needs_hash_check=False,
+                etag=None,
+                mime_type=_get_mime_type(entry.name),
+                cache_control=_get_cache_control(entry.name, hashed_filename),
+            )
+            if key in uploaded_already and uploaded_already[key][0] == size:
+                # At this point, the key exists and the size hasn't changed.
+                # However, for some files, that's not conclusive.
+                # Image, a 'index.html' file might have this as its diff:
+                #
+                #    - <script src=/foo.a9bef19a0.js></script>
+                #    + <script src=/foo.3e98ca01d.js></script>
+                #
+                # ...which means it definitely has changed but the file size is
+                # exactly the same as before.
+                # If this is the case, we're going to *maybe* upload it.
                 task.needs_hash_check = True
-                batch.append(task)
-
-        if len(batch) >= 1000:
-            # Fire off these
-            update_uploaded_stats(
-                _start_uploads(
-                    s3,
-                    config,
-                    batch,
-                    transfer_config,
-                    log=log,
-                    dry_run=config["dry_run"],
-                )
+                task.etag = uploaded_already[key][1]
+            # Otherwise, no doubt! We definitely didn't have this before or it's
+            # definitely different.
+
+            future = executor.submit(
+                _upload_file_maybe,
+                s3,
+                task,
+                config["bucket"],
+                transfer_config,
+                log=log,
+                dry_run=config["dry_run"],
             )
-            total_count += len(batch)
-            batch = []
+            in_flight[future] = task
+            if len(in_flight) >= max_in_flight:
+                wait_for_uploads(concurrent.futures.FIRST_COMPLETED)
 
-    if batch:
-        update_uploaded_stats(
-            _start_uploads(
-                s3, config, batch, transfer_config, log=log, dry_run=config["dry_run"]
-            )
-        )
-        total_count += len(batch)
+        wait_for_uploads(concurrent.futures.ALL_COMPLETED)
+
+    if not config["no_progress_bar"] and total_todo:
+        # In case the last files were all skipped during the scan.
+        draw_progress_bar()
 
     T1 = time.time()
     success(
@@ -338,109 +451,121 @@ def upload_site(directory, config):
     success(f"Done in {fmt_seconds(T1 - T0)}.")
 
 
-def _start_uploads(s3, config, batch, transfer_config, log=info, dry_run=False):
-    T0 = time.time()
-    futures = {}
-    total_threadpool_time = []
-    counts = {"uploaded": 0, "not_uploaded": 0}
-    total_size_uploaded = 0
-    with concurrent.futures.ThreadPoolExecutor(
-        max_workers=MAX_WORKERS_PARALLEL_UPLOADS
-    ) as executor:
-        bucket_name = config["bucket"]
-        for task in batch:
-            futures[
-                executor.submit(
-                    _upload_file_maybe,
-                    s3,
-                    task,
-                    bucket_name,
-                    transfer_config,
-                    log=log,
-                    dry_run=dry_run,
-                )
-            ] = task
-
-        for future in concurrent.futures.as_completed(futures):
-            was_uploaded, took = future.result()
-            task = futures[future]
-            total_threadpool_time.append(took)
-            if was_uploaded:
-                counts["uploaded"] += 1
-                print(f"Adding {task.size} to total_size_uploaded")
-                total_size_uploaded += task.size
-            else:
-                counts["not_uploaded"] += 1
-
-    T1 = time.time()
-
-    return {
-        "counts": counts,
-        "took": T1 - T0,
-        "total_time": sum(total_threadpool_time),
-        "total_size_uploaded": total_size_uploaded,
-    }
+def _list_keys(s3, bucket_name, prefix, delimiter=None):
+    """Return a dict of every key under the prefix mapped to its (size, ETag),
+    and a list of the common prefixes if listed with a delimiter."""
+    keys = {}
+    common_prefixes = []
+    paginate_kwargs = dict(
+        Bucket=bucket_name, Prefix=prefix, PaginationConfig={"PageSize": 1000}
+    )
+    if delimiter:
+        paginate_kwargs["Delimiter"] = delimiter
+    paginator = s3.get_paginator("list_objects_v2")
+    for response in paginator.paginate(**paginate_kwargs):
+        for obj in response.get("Contents", []):
+            keys[obj["Key"]] = (obj["Size"], obj["ETag"].strip('"'))
+        for common_prefix in response.get("CommonPrefixes", []):
+            common_prefixes.append(common_prefix["Prefix"])
+    return keys, common_prefixes
+
+
+def _list_uploaded_already(s3, bucket_name, prefix):
+    # Each page of a listing needs the continuation token from the page before,
+    # so one listing of a big prefix is a long chain of round-trips. Instead,
+    # list the top-level "folders" (e.g. the locales) separately in parallel.
+    uploaded_already, common_prefixes = _list_keys(
+        s3, bucket_name, prefix, delimiter="/"
+    )
+    if common_prefixes:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_WORKERS_PARALLEL_LISTINGS
+        ) as executor:
+            futures = [
+                executor.submit(_list_keys, s3, bucket_name, common_prefix)
+                for common_prefix in common_prefixes
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                keys, _ = future.result()
+                uploaded_already.update(keys)
+    return uploaded_already
 
 
 def pwalk(start):
+    """Yield an `os.DirEntry` for every file under `start`, recursively."""
     for entry in os.scandir(start):
         if entry.is_dir():
-            for p in pwalk(entry):
-                yield p
+            yield from pwalk(entry)
         else:
-            yield Path(entry)
+            yield entry
+
+
+def _is_uploaded_already(s3, bucket_name, task):
+    """Return true if the existing S3 object has exactly the same content as
+    the task's (hashed) local file."""
+    # For a single part upload, the ETag (which we got for free when listing)
+    # is the MD5 of the content.
+    if "-" not in task.etag:
+        return task.etag == task.file_hash
+
+    # Multipart uploads get a different kind of ETag so for those the hash was
+    # stored in the metadata when it was uploaded.
+    try:
+        object_data = s3.head_object(Bucket=bucket_name, Key=task.key)
+    except ClientError as error:
+        # If a client error is thrown, then check that it was a 404 error.
+        # If it was a 404 error, then the key does not exist.
+        if error.response["Error"]["Code"] != "404":
+            raise
+
+        # If it really was a 404, it means that the method that gathered
+        # the existing list is out of sync.
+        return False
+    return object_data["Metadata"].get("filehash") == task.file_hash
 
 
 def _upload_file_maybe(s3, task, bucket_name, transfer_config, log=info, dry_run=False):
     t0 = time.time()
-    if not task.file_hash:
-        task.set_file_hash()
     if task.needs_hash_check:
-        try:
-            object_data = s3.head_object(Bucket=bucket_name, Key=task.key)
-            if object_data["Metadata"].get("filehash") == task.file_hash:
-                # We can bail early!
-                t1 = time.time()
-                start = f"{fmt_size(task.size):} in {fmt_seconds(t1 - t0)}"
-                log(f"Skipped  {start:>19}  {task.key}")
-                return False, t1 - t0
-        except ClientError as error:
-            # If a client error is thrown, then check that it was a 404 error.
-            # If it was a 404 error, then the key does not exist.
-            if error.response["Error"]["Code"] != "404":
-                raise
-
-            # If it really was a 404, it means that the method that gathered
-            # the existing list is out of sync.
-
-    mime_type = mimetypes.guess_type(str(task.file_path))[0] or "binary/octet-stream"
-
-    if os.path.basename(task.file_path) == "service-worker.js":
-        cache_control = "no-cache"
-    else:
-        cache_control_seconds = DEFAULT_CACHE_CONTROL
-        if _has_hashed_filename(task.file_path):
-            cache_control_seconds = HASHED_CACHE_CONTROL
-        cache_control = f"max-age={cache_control_seconds}, public"
+        if not task.file_hash:
+            task.set_file_hash()
+        if _is_uploaded_already(s3, bucket_name, task):
+            # We can bail early!
+            t1 = time.time()
+            start = f"{fmt_size(task.size):} in {fmt_seconds(t1 - t0)}"
+            log(f"Skipped  {start:>19}  {task.key}")
+            return False, t1 - t0
+
+    if not task.file_hash and task.size >= transfer_config.multipart_threshold:
+        # This will be a multipart upload, whose ETag is not the MD5 of the file,
+        # so the hash needs to be stored alongside for the next hash check.
+        task.set_file_hash()
 
     ExtraArgs = {
         "ACL": "public-read",
-        "ContentType": mime_type,
-        "CacheControl": cache_control,
-        "Metadata": {"filehash": task.file_hash},
+        "ContentType": task.mime_type,
+        "CacheControl": task.cache_control,
     }
+    if task.file_hash:
+        ExtraArgs["Metadata"] = {"filehash": task.file_hash}
     # if task.file_path.name == "index.redirect":
     #     with open(task.file_path) as f:
     #         redirect_url = f.read().strip()
     #         ExtraArgs["WebsiteRedirectLocation"] = redirect_url
     if not dry_run:
-        s3.upload_file(
-            str(task.file_path),
-            bucket_name,
-            task.key,
-            ExtraArgs=ExtraArgs,
-            Config=transfer_config,
-        )
+        if task.size < transfer_config.multipart_threshold:
+            # It's going to be a single PUT anyway, so skip upload_file() which
+            # sets up a whole s3transfer manager (and its threads) on every call.
+            with open(task.file_path, "rb") as f:
+                s3.put_object(Bucket=bucket_name, Key=task.key, Body=f, **ExtraArgs)
+        else:
+            s3.upload_file(
+                task.file_path,
+                bucket_name,
+                task.key,
+                ExtraArgs=ExtraArgs,
+                Config=transfer_config,
+            )
     t1 = time.time()
 
     start = f"{fmt_size(task.size)} in {fmt_seconds(t1 - t0)}"
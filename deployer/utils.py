@@ -42,11 +42,13 @@ def is_junk_file(file_path: Path):
     return False
 
 
+_SIZE_UNITS = ((1024 ** 3, "GB"), (1024 ** 2, "MB"), (1024, "KB"))
+
+
 def fmt_size(bytes_):
-    if bytes_ > 1024 * 1024:
-        return f"{bytes_ / 1024 / 1024:.1f}MB"
-    if bytes_ > 1024:
-        return f"{bytes_ / 1024:.1f}KB"
+    for threshold, unit in _SIZE_UNITS:
+        if bytes_ > threshold:
+            return f"{bytes_ / threshold:.1f}{unit}"
     return f"{int(bytes_)}B"
 
 